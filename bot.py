@@ -3,14 +3,31 @@ import os
 import json
 import logging
 import asyncio
+import hashlib
+import random
 import re
+import sys
+from contextlib import asynccontextmanager
+from dataclasses import asdict, dataclass, fields, replace
 from typing import Dict, Optional
 from datetime import datetime
+from weakref import WeakValueDictionary
 
-import aiohttp
+import httpx
+import orjson
+from cachetools import TTLCache
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.constants import ChatAction
+from telegram.error import TelegramError
 from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler, ContextTypes, filters
 
+try:
+    import redis.asyncio as aioredis
+    from redis.exceptions import RedisError
+except ImportError:  # 未安装 redis 时回退到进程内存储
+    aioredis = None
+    RedisError = Exception
+
 # 配置日志
 logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
@@ -18,9 +35,162 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# 不同模型的系统提示词
+SYSTEM_PROMPTS = {
+    'gpt-4': "你是一个专业的AI助手。请提供准确、详细和有帮助的回答。",
+    'gpt-4.1': "你是GPT-4.1，一个高级AI助手。请提供深入、准确的分析和回答。", 
+    'gpt-4o': "你是GPT-4o，一个多模态优化的AI助手。请提供清晰、实用的回答。",
+    'gpt-3.5-turbo-0125': "你是GPT-3.5 Turbo 0125，一个快速响应的AI助手。请提供简洁、准确的回答。",
+    'grok-3': "你是Grok-3，一个具有独特视角的AI助手。请提供有趣、深刻的回答，可以适当幽默。"
+}
+
+# 预先构建的系统消息，所有请求共享同一个普通字典，使用时不得修改
+# （orjson 无法序列化 MappingProxyType，因此没有做成只读）
+_SYSTEM_MSGS = {
+    model: {"role": "system", "content": content} for model, content in SYSTEM_PROMPTS.items()
+}
+_DEFAULT_SYSTEM_MSG = {"role": "system", "content": "你是一个有用的AI助手。"}
+
+@dataclass(slots=True)
+class UserConfig:
+    """单个用户的配置"""
+    api_key: str = ''
+    endpoint: str = ''
+    model: str = ''
+    config_time: float = 0.0  # 配置时间（epoch 秒），0 表示未知
+
+    @property
+    def is_complete(self) -> bool:
+        """API 密钥、端点和模型是否都已配置"""
+        return bool(self.api_key and self.endpoint and self.model)
+
+_USER_CONFIG_FIELDS = frozenset(f.name for f in fields(UserConfig))
+_MISSING = object()
+
+class UserConfigStore:
+    """用户配置存储：Redis 持久化 + 进程内 TTL 缓存，Redis 不可用时回退到内存字典"""
+
+    def __init__(self, redis_url: Optional[str] = None, ttl: int = 2592000,
+                 cache_size: int = 1024, cache_ttl: int = 300):
+        self._ttl = ttl  # Redis 中配置的过期时间（默认 30 天）
+        self._cache = TTLCache(maxsize=cache_size, ttl=cache_ttl)
+        self._lock = asyncio.Lock()
+        # 回退存储：未配置 Redis 时的全部配置，或 Redis 写入失败、尚未同步回 Redis 的配置
+        self._local: Dict[int, UserConfig] = {}
+        self._redis = None
+        if redis_url:
+            if aioredis is None:
+                logger.warning("未安装 redis，用户配置将仅保存在内存中")
+            else:
+                # 短超时：Redis 不可达时尽快回退到内存存储，而不是阻塞处理器
+                self._redis = aioredis.from_url(
+                    redis_url,
+                    decode_responses=True,
+                    socket_connect_timeout=2,
+                    socket_timeout=2
+                )
+
+    @staticmethod
+    def _key(user_id: int) -> str:
+        return f"cfg:{user_id}"
+
+    def _get_local(self, user_id: int) -> Optional[UserConfig]:
+        config = self._local.get(user_id)
+        return replace(config) if config else None
+
+    @staticmethod
+    def _from_hash(data: Dict[str, str]) -> UserConfig:
+        """从 Redis 哈希（值均为字符串）还原用户配置"""
+        config = UserConfig(**{k: v for k, v in data.items() if k in _USER_CONFIG_FIELDS})
+        try:
+            config.config_time = float(config.config_time)
+        except ValueError:
+            config.config_time = 0.0
+        return config
+
+    async def get(self, user_id: int) -> Optional[UserConfig]:
+        """获取用户配置（副本），未配置时返回 None"""
+        async with self._lock:
+            config = self._cache.get(user_id, _MISSING)
+        if config is not _MISSING:
+            return replace(config) if config else None
+        
+        if self._redis is None:
+            return self._get_local(user_id)
+        
+        try:
+            data = await self._redis.hgetall(self._key(user_id))
+        except RedisError as e:
+            logger.warning("Redis read error: %s", e)
+            return self._get_local(user_id)
+        
+        config = self._from_hash(data) if data else None
+        
+        # Redis 故障期间保存的配置比 Redis 中的更新，恢复后写回 Redis
+        pending = self._local.get(user_id)
+        if pending is not None:
+            config = pending
+            # 写回期间 set() 可能又保存了更新的配置，只移除已写回的这一份
+            if await self._write_redis(user_id, pending) and self._local.get(user_id) is pending:
+                del self._local[user_id]
+        
+        # 读取 Redis 期间若有 set() 写入了更新的配置，以缓存中的为准
+        async with self._lock:
+            cached = self._cache.get(user_id, _MISSING)
+            if cached is _MISSING:
+                self._cache[user_id] = config
+            else:
+                config = cached
+        return replace(config) if config else None
+
+    async def set(self, user_id: int, config: UserConfig) -> None:
+        """保存用户配置"""
+        config = replace(config)
+        async with self._lock:
+            self._cache[user_id] = config
+        
+        if self._redis is not None and await self._write_redis(user_id, config):
+            self._local.pop(user_id, None)
+            return
+        
+        self._local[user_id] = config
+
+    async def _write_redis(self, user_id: int, config: UserConfig) -> bool:
+        """写入 Redis（明文哈希），成功返回 True"""
+        try:
+            key = self._key(user_id)
+            async with self._redis.pipeline(transaction=True) as pipe:
+                pipe.delete(key)
+                pipe.hset(key, mapping=asdict(config))
+                pipe.expire(key, self._ttl)
+                await pipe.execute()
+            return True
+        except RedisError as e:
+            logger.warning("Redis write error: %s", e)
+            return False
+
+    async def close(self) -> None:
+        """关闭 Redis 连接"""
+        if self._redis is not None:
+            await self._redis.close()
+
 class AzureOpenAIBot:
+    # 可重试的 HTTP 状态码和最大尝试次数
+    _RETRY_STATUSES = frozenset((408, 429, 500, 502, 503, 504))
+    _MAX_ATTEMPTS = 3
+    # 一次调用（含全部重试）的总超时（秒），httpx 的 timeout 只限制单个阶段
+    _REQUEST_TIMEOUT = 120
+
     def __init__(self):
-        self.user_configs = {}  # userId -> {api_key, endpoint, model}
+        # 用户配置存储：userId -> UserConfig
+        self.configs = UserConfigStore(os.getenv('REDIS_URL'))
+        # 共享的 HTTP/2 客户端，在同一连接上多路复用到 Azure 端点的请求
+        self._client: Optional[httpx.AsyncClient] = None
+        # 并发限制：每个用户最多 3 个、全局最多 50 个进行中的上游请求
+        self._user_sems: WeakValueDictionary = WeakValueDictionary()
+        self._global_sem = asyncio.Semaphore(50)
+        # 进行中的上游请求：请求指纹 -> Task
+        self._inflight: Dict[str, asyncio.Future] = {}
         # 支持的模型列表
         self.available_models = {
             'gpt-4': '🧠 GPT-4',
@@ -39,6 +209,73 @@ class AzureOpenAIBot:
             'gpt-3.5-turbo-0125': {'max_tokens': 4000, 'temperature': 0.7},
             'grok-3': {'max_tokens': 4000, 'temperature': 0.8}
         }
+        
+        # 预先生成每个模型的 URL 路径和请求体模板，避免每次请求重复拼装
+        self._url_paths = {
+            model: self._build_url_path(model) for model in self.available_models
+        }
+        self._payload_templates = {
+            model: self._build_payload_template(model) for model in self.available_models
+        }
+        
+        # 模型选择界面的提示文本：当前模型 -> 文本
+        self._model_menu_text = {
+            model_id: self._format_model_menu_text(model_name)
+            for model_id, model_name in self.available_models.items()
+        }
+        
+        # 模型选择键盘缓存：当前模型 -> InlineKeyboardMarkup
+        self._keyboard_cache: Dict[Optional[str], InlineKeyboardMarkup] = {}
+        # 键盘底部固定的功能按钮
+        self._keyboard_tail = [
+            [InlineKeyboardButton("🔄 刷新列表", callback_data="model:refresh")],
+            [InlineKeyboardButton("📊 模型对比", callback_data="model:compare")],
+            [InlineKeyboardButton("❌ 取消", callback_data="model:cancel")]
+        ]
+
+    @staticmethod
+    def _format_model_menu_text(current_display: str) -> str:
+        """构建模型选择界面的提示文本"""
+        return f"🔄 选择要使用的 AI 模型\n\n当前模型: {current_display}\n\n点击下方按钮切换："
+
+    def model_menu_text(self, current_model: str) -> str:
+        """获取模型选择界面的提示文本"""
+        return self._model_menu_text.get(current_model) or self._format_model_menu_text(current_model)
+
+    def build_model_keyboard(self, current_model: str) -> InlineKeyboardMarkup:
+        """获取模型选择键盘，按当前模型缓存"""
+        # 未知模型的键盘都没有勾选项，共用一个缓存键，缓存大小有上限
+        if current_model not in self.available_models:
+            current_model = None
+        reply_markup = self._keyboard_cache.get(current_model)
+        if reply_markup is None:
+            keyboard = []
+            # 创建模型选择按钮
+            for model_id, model_name in self.available_models.items():
+                button_text = f"{'✅ ' if model_id == current_model else ''}{model_name}"
+                keyboard.append([InlineKeyboardButton(button_text, callback_data=f"model:{model_id}")])
+            # 添加功能按钮
+            keyboard.extend(self._keyboard_tail)
+            reply_markup = InlineKeyboardMarkup(keyboard)
+            self._keyboard_cache[current_model] = reply_markup
+        return reply_markup
+
+    def _build_url_path(self, model: str) -> str:
+        """构建模型的 API 路径（拼接在端点之后）- 支持不同的 API 版本"""
+        # Grok 可能使用不同的 API 版本或端点
+        api_version = '2024-08-01-preview' if model == 'grok-3' else '2024-02-15-preview'
+        return "/openai/deployments/" + model + "/chat/completions?api-version=" + api_version
+
+    def _build_payload_template(self, model: str) -> Dict:
+        """构建模型的请求体模板（不含 messages）"""
+        model_config = self.model_configs.get(model, self.model_configs['gpt-4o'])
+        return {
+            'max_tokens': model_config['max_tokens'],
+            'temperature': model_config['temperature'],
+            'top_p': 0.95,
+            'frequency_penalty': 0,
+            'presence_penalty': 0
+        }
     
     def preprocess_math_formulas(self, text: str) -> str:
         """预处理数学公式，将LaTeX格式转换为Telegram支持的格式"""
@@ -119,58 +356,135 @@ class AzureOpenAIBot:
             text = re.sub(pattern, replacement, text)
         
         return text
+
+    async def init_client(self) -> None:
+        """创建共享的 HTTP 客户端（连接池）"""
+        if self._client is None or self._client.is_closed:
+            self._client = httpx.AsyncClient(
+                http2=True,
+                timeout=120.0,
+                limits=httpx.Limits(
+                    max_connections=100,
+                    max_keepalive_connections=30,
+                    keepalive_expiry=75
+                )
+            )
+
+    async def close_client(self) -> None:
+        """关闭共享的 HTTP 客户端"""
+        if self._client is not None and not self._client.is_closed:
+            await self._client.aclose()
+        self._client = None
         
-    async def call_azure_openai(self, user_config: Dict, messages: list) -> Optional[str]:
+    @asynccontextmanager
+    async def request_slot(self, user_id: int):
+        """获取上游请求的并发名额（先占用户名额，再占全局名额）"""
+        user_sem = self._user_sems.get(user_id)
+        if user_sem is None:
+            user_sem = asyncio.Semaphore(3)
+            self._user_sems[user_id] = user_sem
+        async with user_sem, self._global_sem:
+            yield
+
+    async def call_azure_openai(self, user_config: UserConfig, messages: list) -> Optional[str]:
         """调用 Azure OpenAI API"""
-        if not all(k in user_config for k in ['api_key', 'endpoint', 'model']):
+        if not user_config.is_complete:
             return "❌ 请先配置 API 信息，使用 /config 命令"
             
-        model = user_config['model']
-        model_config = self.model_configs.get(model, self.model_configs['gpt-4o'])
+        model = user_config.model
         
-        # 构建 API URL - 支持不同的 API 版本
-        if model == 'grok-3':
-            # Grok 可能使用不同的 API 版本或端点
-            url = f"{user_config['endpoint']}/openai/deployments/{model}/chat/completions?api-version=2024-08-01-preview"
-        else:
-            url = f"{user_config['endpoint']}/openai/deployments/{model}/chat/completions?api-version=2024-02-15-preview"
+        # 构建 API URL 和请求体（未知模型时现场生成）
+        # 直接拼接而不用 str.format，模型名中的花括号不会引发异常
+        url_path = self._url_paths.get(model) or self._build_url_path(model)
+        payload_template = self._payload_templates.get(model) or self._build_payload_template(model)
+        url = user_config.endpoint + url_path
         
         headers = {
             'Content-Type': 'application/json',
-            'api-key': user_config['api_key']
+            'api-key': user_config.api_key
         }
         
-        payload = {
-            'messages': messages,
-            'max_tokens': model_config['max_tokens'],
-            'temperature': model_config['temperature'],
-            'top_p': 0.95,
-            'frequency_penalty': 0,
-            'presence_penalty': 0
-        }
+        payload = {**payload_template, 'messages': messages}
+        
+        # 客户端尚未创建时（例如未经 main() 启动）懒加载
+        await self.init_client()
+        
+        data = orjson.dumps(payload)
         
+        # 合并相同的进行中请求：同一端点、密钥和请求体只发起一次上游调用
+        key = hashlib.blake2b(
+            b"|".join((url.encode(), user_config.api_key.encode(), data)),
+            digest_size=16
+        ).hexdigest()
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._post_with_retry(url, headers, data))
+            self._inflight[key] = task
+            task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        # shield: 单个调用方被取消时不影响其他等待同一结果的调用方
+        return await asyncio.shield(task)
+
+    async def _post_with_retry(self, url: str, headers: Dict, data: bytes) -> Optional[str]:
+        """发送请求，所有重试共用一个总超时"""
         try:
-            async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=120)) as session:
-                async with session.post(url, headers=headers, json=payload) as response:
-                    if response.status == 200:
-                        result = await response.json()
-                        return result['choices'][0]['message']['content']
-                    else:
-                        error_text = await response.text()
-                        logger.error(f"Azure API Error: {response.status} - {error_text}")
-                        return f"❌ API 调用失败 ({response.status})\n{error_text[:300]}..."
+            async with asyncio.timeout(self._REQUEST_TIMEOUT):
+                return await self._post_attempts(url, headers, data)
         except asyncio.TimeoutError:
             logger.error("API request timeout")
             return "❌ 请求超时，请稍后再试"
-        except Exception as e:
-            logger.error(f"Request error: {e}")
-            return f"❌ 请求错误: {str(e)}"
+
+    async def _post_attempts(self, url: str, headers: Dict, data: bytes) -> Optional[str]:
+        """429/5xx 和连接错误时指数退避重试，只有最后一次失败才返回错误信息"""
+        for attempt in range(self._MAX_ATTEMPTS):
+            last_attempt = attempt == self._MAX_ATTEMPTS - 1
+            try:
+                response = await self._client.post(url, headers=headers, content=data)
+                if response.status_code == 200:
+                    result = orjson.loads(response.content)
+                    return result['choices'][0]['message']['content']
+                
+                error_text = response.text[:300]
+                if last_attempt or response.status_code not in self._RETRY_STATUSES:
+                    logger.error("Azure API Error: %s - %s", response.status_code, error_text)
+                    return f"❌ API 调用失败 ({response.status_code})\n{error_text}..."
+                
+                delay = self._retry_delay(attempt, response.headers.get('Retry-After'))
+                logger.warning("Azure API Error: %s, retrying in %.2fs", response.status_code, delay)
+            except httpx.TimeoutException:
+                if last_attempt:
+                    logger.error("API request timeout")
+                    return "❌ 请求超时，请稍后再试"
+                delay = self._retry_delay(attempt)
+                logger.warning("API request timeout, retrying in %.2fs", delay)
+            except (httpx.NetworkError, httpx.RemoteProtocolError) as e:
+                if last_attempt:
+                    logger.error("Request error: %s", e)
+                    return f"❌ 请求错误: {str(e)}"
+                delay = self._retry_delay(attempt)
+                logger.warning("Connection error: %s, retrying in %.2fs", e, delay)
+            except Exception as e:
+                logger.error("Request error: %s", e)
+                return f"❌ 请求错误: {str(e)}"
+            
+            await asyncio.sleep(delay)
+
+    @staticmethod
+    def _retry_delay(attempt: int, retry_after: Optional[str] = None) -> float:
+        """计算重试等待时间，优先使用服务端的 Retry-After"""
+        if retry_after:
+            try:
+                delay = float(retry_after)
+            except ValueError:
+                delay = 0.0
+            # 0 或负值视为无效，回退到指数退避
+            if delay > 0:
+                return min(delay, 30.0)
+        return 0.5 * (2 ** attempt) + random.random() * 0.25
 
 bot_instance = AzureOpenAIBot()
 
-async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """开始命令"""
-    welcome_text = """
+# 静态文本和消息模板，模块加载时构建一次
+_WELCOME_TEXT = """
 🤖 Azure OpenAI Telegram Bot
 
 支持的模型：
@@ -199,17 +513,10 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
 /clear - 清除对话历史
 /help - 帮助信息
 
-🔒 隐私保护：每个用户的配置独立存储，API 密钥安全加密
-    """
-    await update.message.reply_text(welcome_text, parse_mode='Markdown')
+🔒 隐私保护：每个用户的配置独立存储，API 密钥仅用于调用你自己的 Azure 接口
+"""
 
-async def config_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """配置 API 信息"""
-    args = context.args
-    user_id = update.effective_user.id
-    
-    if len(args) < 2:
-        config_text = """
+_CONFIG_USAGE_TEXT = """
 🔧 配置 Azure OpenAI API
 
 使用方法：
@@ -235,103 +542,108 @@ async def config_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 • grok-3
 
 确保你的 Azure 资源中已部署这些模型！
-        """
-        await update.message.reply_text(config_text, parse_mode='Markdown')
-        return
-    
-    api_key = args[0]
-    endpoint = args[1].rstrip('/')
-    
-    # 验证输入格式
-    if not endpoint.startswith('https://'):
-        await update.message.reply_text("❌ 端点 URL 必须以 https:// 开头", parse_mode='Markdown')
-        return
-    
-    if len(api_key) < 20:
-        await update.message.reply_text("❌ API 密钥格式似乎不正确，请检查", parse_mode='Markdown')
-        return
-    
-    # 初始化用户配置
-    if user_id not in bot_instance.user_configs:
-        bot_instance.user_configs[user_id] = {}
-    
-    bot_instance.user_configs[user_id].update({
-        'api_key': api_key,
-        'endpoint': endpoint,
-        'model': bot_instance.user_configs[user_id].get('model', bot_instance.default_model),
-        'config_time': datetime.now().isoformat()
-    })
-    
-    model_display = bot_instance.available_models.get(
-        bot_instance.user_configs[user_id]['model'], 
-        bot_instance.user_configs[user_id]['model']
-    )
-    
-    success_msg = f"""
+"""
+
+_CONFIG_SUCCESS_TEMPLATE = """
 ✅ API 配置已保存！
 
 🌐 端点: {endpoint}
 🤖 当前模型: {model_display}
-🕒 配置时间: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}
+🕒 配置时间: {config_time}
 
 ⚠️ 安全提醒：
 请立即删除上面包含 API 密钥的消息！
 
 💡 下一步：
 使用 /model 选择或切换模型，然后就可以开始对话了！
-    """
-    
-    await update.message.reply_text(success_msg, parse_mode='Markdown')
+"""
 
-async def model_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """选择模型"""
-    user_id = update.effective_user.id
-    user_config = bot_instance.user_configs.get(user_id, {})
-    
-    if not user_config.get('api_key'):
-        await update.message.reply_text(
-            "❌ 请先使用 /config 配置 API 信息\n\n"
-            "格式：/config <API_KEY> <ENDPOINT>",
-            parse_mode='Markdown'
-        )
-        return
-    
-    keyboard = []
-    current_model = user_config.get('model', bot_instance.default_model)
-    
-    # 创建模型选择按钮
-    for model_id, model_name in bot_instance.available_models.items():
-        button_text = f"{'✅ ' if model_id == current_model else ''}{model_name}"
-        keyboard.append([InlineKeyboardButton(button_text, callback_data=f"model:{model_id}")])
-    
-    # 添加功能按钮
-    keyboard.extend([
-        [InlineKeyboardButton("🔄 刷新列表", callback_data="model:refresh")],
-        [InlineKeyboardButton("📊 模型对比", callback_data="model:compare")],
-        [InlineKeyboardButton("❌ 取消", callback_data="model:cancel")]
-    ])
-    
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    
-    current_display = bot_instance.available_models.get(current_model, current_model)
-    text = f"🔄 选择要使用的 AI 模型\n\n当前模型: {current_display}\n\n点击下方按钮切换："
-    
-    await update.message.reply_text(text, reply_markup=reply_markup, parse_mode='Markdown')
+_MODEL_SWITCH_TEMPLATE = """
+✅ 模型切换成功！
 
-async def model_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """处理模型选择回调"""
-    query = update.callback_query
-    await query.answer()
-    
-    user_id = update.effective_user.id
-    action = query.data.split(':')[1]
-    
-    if action == 'cancel':
-        await query.edit_message_text("❌ 已取消模型选择", parse_mode='Markdown')
-        return
-    
-    if action == 'compare':
-        compare_text = """
+从：{old_display}
+到：{new_display}
+
+🚀 现在可以开始对话了！
+直接发送消息即可体验新模型。
+
+💡 提示：不同模型有不同的特点，可以尝试相同问题在不同模型下的回答。
+"""
+
+_STATUS_TEMPLATE = """
+📊 当前配置状态
+
+🔑 API 密钥: {api_key_status}
+🌐 API 端点: {endpoint}
+🤖 当前模型: {model_display}
+🕒 配置时间: {config_time}
+
+📈 可用模型: {model_count} 个
+🛡️ 配置状态: {config_status}
+
+💡 命令提示:
+• /model - 切换模型
+• /config - 重新配置 API
+• /clear - 清除对话历史
+"""
+
+_SETUP_REQUIRED_TEXT = """
+❌ 请先完成配置
+
+📝 配置步骤：
+1️⃣ /config <API_KEY> <ENDPOINT>
+2️⃣ /model (选择模型)
+3️⃣ 发送消息开始对话
+
+💡 示例：
+/config sk-abc123... https://your-resource.openai.azure.com
+"""
+
+_HELP_TEXT = """
+🆘 Azure OpenAI Bot 完整指南
+
+🚀 支持的模型：
+🧠 GPT-4 - 超强推理能力
+🚀 GPT-4.1 - GPT-4升级版
+✨ GPT-4o - 多模态优化
+⚡ GPT-3.5 Turbo 0125 - 快速响应  
+🤖 Grok-3 - xAI最新模型
+
+📋 命令列表：
+/start - 开始使用机器人
+/config <API_KEY> <ENDPOINT> - 配置 Azure API
+/model - 选择/切换模型
+/status - 查看当前配置状态
+/clear - 清除对话历史
+/help - 显示帮助信息
+
+🔧 使用步骤：
+1️⃣ 获取 Azure OpenAI API 密钥和端点
+2️⃣ 使用 /config 命令配置 API 信息
+3️⃣ 使用 /model 选择想要使用的模型
+4️⃣ 直接发送消息开始与 AI 对话
+
+💡 使用技巧：
+• 不同模型有不同特点，可以切换体验
+• GPT-4系列适合复杂推理任务
+• GPT-3.5 Turbo 0125适合快速日常对话
+• Grok-3提供独特的对话体验
+
+⚠️ 安全提示：
+• 请在私聊中配置API密钥
+• 配置后立即删除包含密钥的消息  
+• 定期更换API密钥
+• 不要分享你的配置信息
+
+🛡️ 隐私保护：
+每个用户的配置完全独立，API密钥仅用于调用你的 Azure 接口，
+机器人不会记录或分享你的对话内容。
+
+需要帮助？发送任何消息给我！
+"""
+
+# 模型对比信息
+_COMPARE_TEXT = """
 📊 模型对比信息
 
 🧠 GPT-4
@@ -368,63 +680,136 @@ async def model_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
 • 复杂任务 → GPT-4 / GPT-4.1
 • 日常对话 → GPT-4o / GPT-3.5 Turbo 0125
 • 创新体验 → Grok-3
-        """
-        await query.edit_message_text(compare_text, parse_mode='Markdown')
+"""
+
+async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """开始命令"""
+    await update.message.reply_text(_WELCOME_TEXT, parse_mode='Markdown')
+
+async def config_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """配置 API 信息"""
+    args = context.args
+    user_id = update.effective_user.id
+    
+    if len(args) < 2:
+        await update.message.reply_text(_CONFIG_USAGE_TEXT, parse_mode='Markdown')
         return
     
-    if action == 'refresh':
-        # 重新显示模型选择界面
-        keyboard = []
-        user_config = bot_instance.user_configs.get(user_id, {})
-        current_model = user_config.get('model', bot_instance.default_model)
-        
-        for model_id, model_name in bot_instance.available_models.items():
-            button_text = f"{'✅ ' if model_id == current_model else ''}{model_name}"
-            keyboard.append([InlineKeyboardButton(button_text, callback_data=f"model:{model_id}")])
-        
-        keyboard.extend([
-            [InlineKeyboardButton("🔄 刷新列表", callback_data="model:refresh")],
-            [InlineKeyboardButton("📊 模型对比", callback_data="model:compare")],
-            [InlineKeyboardButton("❌ 取消", callback_data="model:cancel")]
-        ])
-        
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        current_display = bot_instance.available_models.get(current_model, current_model)
-        text = f"🔄 选择要使用的 AI 模型\n\n当前模型: {current_display}\n\n点击下方按钮切换："
-        
-        await query.edit_message_text(text, reply_markup=reply_markup, parse_mode='Markdown')
+    api_key = args[0]
+    endpoint = args[1]
+    
+    # 验证输入格式（先做开销最小的检查）
+    if len(api_key) < 20:
+        await update.message.reply_text("❌ API 密钥格式似乎不正确，请检查", parse_mode='Markdown')
         return
     
-    # 更新用户选择的模型
-    if user_id not in bot_instance.user_configs:
-        bot_instance.user_configs[user_id] = {}
+    # 仅在有尾部斜杠时才生成新字符串
+    if endpoint.endswith('/'):
+        endpoint = endpoint.rstrip('/')
     
-    old_model = bot_instance.user_configs[user_id].get('model', 'none')
-    bot_instance.user_configs[user_id]['model'] = action
+    # 去掉尾部斜杠后再检查，https:// 之后必须有主机名
+    if not endpoint.startswith('https://') or len(endpoint) == len('https://'):
+        await update.message.reply_text("❌ 端点 URL 必须以 https:// 开头", parse_mode='Markdown')
+        return
     
-    old_display = bot_instance.available_models.get(old_model, old_model)
-    new_display = bot_instance.available_models.get(action, action)
+    # 更新用户配置
+    user_config = await bot_instance.configs.get(user_id) or UserConfig()
+    user_config.api_key = api_key
+    user_config.endpoint = endpoint
+    user_config.model = user_config.model or bot_instance.default_model
+    user_config.config_time = datetime.now().timestamp()
+    await bot_instance.configs.set(user_id, user_config)
     
-    success_text = f"""
-✅ 模型切换成功！
+    model_display = bot_instance.available_models.get(user_config.model, user_config.model)
+    
+    success_msg = _CONFIG_SUCCESS_TEMPLATE.format(
+        endpoint=endpoint,
+        model_display=model_display,
+        config_time=datetime.fromtimestamp(user_config.config_time).strftime('%Y-%m-%d %H:%M:%S')
+    )
+    
+    await update.message.reply_text(success_msg, parse_mode='Markdown')
 
-从：{old_display}
-到：{new_display}
+async def model_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """选择模型"""
+    user_id = update.effective_user.id
+    user_config = await bot_instance.configs.get(user_id)
+    
+    if user_config is None or not user_config.api_key:
+        await update.message.reply_text(
+            "❌ 请先使用 /config 配置 API 信息\n\n"
+            "格式：/config <API_KEY> <ENDPOINT>",
+            parse_mode='Markdown'
+        )
+        return
+    
+    current_model = user_config.model or bot_instance.default_model
+    reply_markup = bot_instance.build_model_keyboard(current_model)
+    text = bot_instance.model_menu_text(current_model)
+    
+    await update.message.reply_text(text, reply_markup=reply_markup, parse_mode='Markdown')
 
-🚀 现在可以开始对话了！
-直接发送消息即可体验新模型。
+async def _do_cancel(query, user_id: int):
+    """取消模型选择"""
+    await query.edit_message_text("❌ 已取消模型选择", parse_mode='Markdown')
 
-💡 提示：不同模型有不同的特点，可以尝试相同问题在不同模型下的回答。
-    """
+async def _do_compare(query, user_id: int):
+    """显示模型对比信息"""
+    await query.edit_message_text(_COMPARE_TEXT, parse_mode='Markdown')
+
+async def _do_refresh(query, user_id: int):
+    """重新显示模型选择界面"""
+    user_config = await bot_instance.configs.get(user_id)
+    current_model = (user_config and user_config.model) or bot_instance.default_model
+    reply_markup = bot_instance.build_model_keyboard(current_model)
+    text = bot_instance.model_menu_text(current_model)
+    
+    await query.edit_message_text(text, reply_markup=reply_markup, parse_mode='Markdown')
+
+# 模型选择回调中的功能按钮：action -> 处理函数
+_CALLBACK_ACTIONS = {
+    'cancel': _do_cancel,
+    'compare': _do_compare,
+    'refresh': _do_refresh,
+}
+
+async def model_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """处理模型选择回调"""
+    query = update.callback_query
+    await query.answer()
+    
+    user_id = update.effective_user.id
+    action = query.data[len("model:"):]
+    
+    handler = _CALLBACK_ACTIONS.get(action)
+    if handler:
+        await handler(query, user_id)
+        return
+    
+    # 回调数据可能被伪造，只接受已知的模型
+    if action not in bot_instance.available_models:
+        await query.edit_message_text("❌ 未知的模型", parse_mode='Markdown')
+        return
+    
+    # 更新用户选择的模型
+    user_config = await bot_instance.configs.get(user_id) or UserConfig()
+    old_model = user_config.model or 'none'
+    user_config.model = action
+    await bot_instance.configs.set(user_id, user_config)
+    
+    old_display = bot_instance.available_models.get(old_model, old_model)
+    new_display = bot_instance.available_models.get(action, action)
+    
+    success_text = _MODEL_SWITCH_TEMPLATE.format(old_display=old_display, new_display=new_display)
     
     await query.edit_message_text(success_text, parse_mode='Markdown')
 
 async def status_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """查看当前配置状态"""
     user_id = update.effective_user.id
-    user_config = bot_instance.user_configs.get(user_id, {})
+    user_config = await bot_instance.configs.get(user_id)
     
-    if not user_config:
+    if user_config is None:
         await update.message.reply_text(
             "❌ 尚未配置 API 信息\n\n"
             "请使用 /config 命令配置你的 Azure OpenAI API",
@@ -432,35 +817,21 @@ async def status_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         return
     
-    model = user_config.get('model', '未选择')
+    model = user_config.model or '未选择'
     model_display = bot_instance.available_models.get(model, model)
-    config_time = user_config.get('config_time', '未知')
-    
-    if config_time != '未知':
-        try:
-            config_dt = datetime.fromisoformat(config_time)
-            config_time_str = config_dt.strftime('%Y-%m-%d %H:%M:%S')
-        except:
-            config_time_str = config_time
-    else:
-        config_time_str = '未知'
+    config_time_str = (
+        datetime.fromtimestamp(user_config.config_time).strftime('%Y-%m-%d %H:%M:%S')
+        if user_config.config_time else '未知'
+    )
     
-    status_text = f"""
-📊 当前配置状态
-
-🔑 API 密钥: {'✅ 已配置' if user_config.get('api_key') else '❌ 未配置'}
-🌐 API 端点: {user_config.get('endpoint', '❌ 未配置')}
-🤖 当前模型: {model_display}
-🕒 配置时间: {config_time_str}
-
-📈 可用模型: {len(bot_instance.available_models)} 个
-🛡️ 配置状态: {'✅ 完整' if all(k in user_config for k in ['api_key', 'endpoint', 'model']) else '⚠️ 不完整'}
-
-💡 命令提示:
-• /model - 切换模型
-• /config - 重新配置 API
-• /clear - 清除对话历史
-    """
+    status_text = _STATUS_TEMPLATE.format(
+        api_key_status='✅ 已配置' if user_config.api_key else '❌ 未配置',
+        endpoint=user_config.endpoint or '❌ 未配置',
+        model_display=model_display,
+        config_time=config_time_str,
+        model_count=len(bot_instance.available_models),
+        config_status='✅ 完整' if user_config.is_complete else '⚠️ 不完整'
+    )
     
     await update.message.reply_text(status_text, parse_mode='Markdown')
 
@@ -476,54 +847,41 @@ async def clear_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         parse_mode='Markdown'
     )
 
+async def _keep_typing(bot, chat_id: int, interval: float = 4.0):
+    """每隔几秒重新发送"正在输入"状态（Telegram 约 5 秒后自动清除），直到被取消"""
+    while True:
+        try:
+            await bot.send_chat_action(chat_id=chat_id, action=ChatAction.TYPING)
+        except TelegramError as e:
+            logger.warning("send_chat_action error: %s", e)
+        await asyncio.sleep(interval)
+
 async def chat_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """处理聊天消息"""
     user_id = update.effective_user.id
-    user_config = bot_instance.user_configs.get(user_id, {})
+    user_config = await bot_instance.configs.get(user_id)
     
-    if not all(k in user_config for k in ['api_key', 'endpoint', 'model']):
-        help_text = """
-❌ 请先完成配置
-
-📝 配置步骤：
-1️⃣ /config <API_KEY> <ENDPOINT>
-2️⃣ /model (选择模型)
-3️⃣ 发送消息开始对话
-
-💡 示例：
-/config sk-abc123... https://your-resource.openai.azure.com
-        """
-        await update.message.reply_text(help_text, parse_mode='Markdown')
+    if user_config is None or not user_config.is_complete:
+        await update.message.reply_text(_SETUP_REQUIRED_TEXT, parse_mode='Markdown')
         return
     
     user_message = update.message.text
-    model = user_config['model']
+    model = user_config.model
     model_display = bot_instance.available_models.get(model, model)
     
-    # 发送"正在思考"的消息
-    thinking_msg = await update.message.reply_text(f"🤔 {model_display} 正在思考...", parse_mode='Markdown')
-    
-    # 构建消息历史
-    system_prompts = {
-        'gpt-4': "你是一个专业的AI助手。请提供准确、详细和有帮助的回答。",
-        'gpt-4.1': "你是GPT-4.1，一个高级AI助手。请提供深入、准确的分析和回答。", 
-        'gpt-4o': "你是GPT-4o，一个多模态优化的AI助手。请提供清晰、实用的回答。",
-        'gpt-3.5-turbo-0125': "你是GPT-3.5 Turbo 0125，一个快速响应的AI助手。请提供简洁、准确的回答。",
-        'grok-3': "你是Grok-3，一个具有独特视角的AI助手。请提供有趣、深刻的回答，可以适当幽默。"
-    }
-    
-    system_content = system_prompts.get(model, "你是一个有用的AI助手。")
-    
+    # 构建消息历史（系统消息为共享字典，不得修改）
     messages = [
-        {"role": "system", "content": system_content},
+        _SYSTEM_MSGS.get(model, _DEFAULT_SYSTEM_MSG),
         {"role": "user", "content": user_message}
     ]
     
-    # 调用 Azure OpenAI API
-    response = await bot_instance.call_azure_openai(user_config, messages)
-    
-    # 删除"正在思考"的消息
-    await thinking_msg.delete()
+    # 调用 Azure OpenAI API，期间持续显示"正在输入"状态
+    typing_task = asyncio.create_task(_keep_typing(context.bot, update.effective_chat.id))
+    try:
+        async with bot_instance.request_slot(user_id):
+            response = await bot_instance.call_azure_openai(user_config, messages)
+    finally:
+        typing_task.cancel()
     
     if response:
         # 预处理数学公式
@@ -532,8 +890,9 @@ async def chat_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         # 如果回复太长，分段发送
         max_length = 4000
         if len(processed_response) > max_length:
-            parts = [processed_response[i:i+max_length] for i in range(0, len(processed_response), max_length)]
-            for i, part in enumerate(parts):
+            # 逐段切片并立即发送，不预先生成全部分段
+            for i in range(0, len(processed_response), max_length):
+                part = processed_response[i:i+max_length]
                 if i == 0:
                     await update.message.reply_text(f"💬 {model_display} 回复：\n\n{part}", parse_mode='Markdown')
                 else:
@@ -545,60 +904,41 @@ async def chat_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """帮助命令"""
-    help_text = """
-🆘 Azure OpenAI Bot 完整指南
+    await update.message.reply_text(_HELP_TEXT, parse_mode='Markdown')
 
-🚀 支持的模型：
-🧠 GPT-4 - 超强推理能力
-🚀 GPT-4.1 - GPT-4升级版
-✨ GPT-4o - 多模态优化
-⚡ GPT-3.5 Turbo 0125 - 快速响应  
-🤖 Grok-3 - xAI最新模型
+async def _post_init(application: Application):
+    """应用启动后创建共享的 HTTP 客户端"""
+    await bot_instance.init_client()
 
-📋 命令列表：
-/start - 开始使用机器人
-/config <API_KEY> <ENDPOINT> - 配置 Azure API
-/model - 选择/切换模型
-/status - 查看当前配置状态
-/clear - 清除对话历史
-/help - 显示帮助信息
-
-🔧 使用步骤：
-1️⃣ 获取 Azure OpenAI API 密钥和端点
-2️⃣ 使用 /config 命令配置 API 信息
-3️⃣ 使用 /model 选择想要使用的模型
-4️⃣ 直接发送消息开始与 AI 对话
-
-💡 使用技巧：
-• 不同模型有不同特点，可以切换体验
-• GPT-4系列适合复杂推理任务
-• GPT-3.5 Turbo 0125适合快速日常对话
-• Grok-3提供独特的对话体验
-
-⚠️ 安全提示：
-• 请在私聊中配置API密钥
-• 配置后立即删除包含密钥的消息  
-• 定期更换API密钥
-• 不要分享你的配置信息
-
-🛡️ 隐私保护：
-每个用户的配置完全独立，API密钥安全存储，
-机器人不会记录或分享你的对话内容。
-
-需要帮助？发送任何消息给我！
-    """
-    await update.message.reply_text(help_text, parse_mode='Markdown')
+async def _post_shutdown(application: Application):
+    """应用关闭时释放共享的 HTTP 客户端和配置存储连接"""
+    await bot_instance.close_client()
+    await bot_instance.configs.close()
 
 def main():
     """启动机器人"""
+    # 优先使用基于 libuv 的 uvloop 事件循环（Windows 不支持）
+    if sys.platform != 'win32':
+        try:
+            import uvloop
+            uvloop.install()
+        except ImportError:
+            logger.info("未安装 uvloop，使用默认事件循环")
+    
     # 从环境变量获取 Bot Token
     token = os.getenv('TELEGRAM_BOT_TOKEN')
     if not token:
         logger.error("请设置 TELEGRAM_BOT_TOKEN 环境变量")
         return
     
-    # 创建应用
-    application = Application.builder().token(token).build()
+    # 创建应用，启动/关闭时创建/释放共享资源
+    application = (
+        Application.builder()
+        .token(token)
+        .post_init(_post_init)
+        .post_shutdown(_post_shutdown)
+        .build()
+    )
     
     # 注册命令处理器
     application.add_handler(CommandHandler("start", start))
@@ -612,11 +952,13 @@ def main():
     application.add_handler(CallbackQueryHandler(model_callback, pattern="^model:"))
     
     # 注册消息处理器
-    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, chat_handler))
+    # block=False: 聊天消息并发处理，上游并发由 request_slot 限制；
+    # 命令和回调仍按顺序处理，避免配置的读-改-写相互覆盖
+    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, chat_handler, block=False))
     
     # 启动机器人
     logger.info("Azure OpenAI Telegram Bot 启动中...")
-    logger.info(f"支持的模型: {list(bot_instance.available_models.keys())}")
+    logger.info("支持的模型: %s", list(bot_instance.available_models.keys()))
     application.run_polling(allowed_updates=Update.ALL_TYPES)
 
 if __name__ == '__main__':